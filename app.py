@@ -3,19 +3,26 @@
 
 # --- 0. Imports & Constants ---
 import streamlit as st
-import pandas as pd
+import numpy as np
 import os
 import random
 import time
+import threading
+import io
+import queue
+import csv
+from operator import itemgetter
+from types import MappingProxyType
 
 try:
     import psycopg2
-    from psycopg2.extras import DictCursor
-    from psycopg2.pool import SimpleConnectionPool
+    from psycopg2.extras import RealDictCursor, execute_values
+    from psycopg2.pool import ThreadedConnectionPool
 except ImportError:
     psycopg2 = None
-    DictCursor = None
-    SimpleConnectionPool = None
+    RealDictCursor = None
+    execute_values = None
+    ThreadedConnectionPool = None
 
 import sqlite3
 
@@ -35,6 +42,9 @@ import sqlite3
 #    - KEY: `ADMIN_PW`
 #      VALUE: あなたが設定する管理者パスワード
 #
+#    - KEY: `PG_MAXCONN`（任意）
+#      VALUE: 接続プールの上限（既定は40。DBプランの接続数上限より小さくしてください）
+#
 # 3. このコードは、環境変数 `DATABASE_URL` が存在する場合にPostgreSQLを使い、
 #    存在しない場合はローカルテスト用に `local_market.db` というSQLiteファイルを使用します。
 # ----------------------------------------------------
@@ -47,64 +57,172 @@ ENDOWMENT_MULTIPLIER = 111
 MAX_PRICE = 300
 MAX_UNITS = 5
 PRICE_RANGE = range(0, MAX_PRICE + 1)
+MU_COLS = tuple(f"mu{i + 1}" for i in range(MAX_UNITS))  # 各ユニットの評価額の列名
+get_mus = itemgetter(*MU_COLS)  # 1行分の評価額を (mu1, ..., mu5) のタプルで一度に取り出す
+PLAYER_POLL_SECONDS = 3  # 結果待ちのプレイヤー画面が group_info を確認する間隔（秒）
+
+# SQL（毎回同じ文字列を渡し、sqlite3 の文キャッシュに載せる）
+# {p} 入りの文は読み込み時に %s / ? の両方を組み立てておき、呼び出し側は SQL[conn.placeholder] で引く
+def by_placeholder(template):
+    return {ph: template.format(p=ph) for ph in ("%s", "?")}
+
+# 読み取りは SELECT * を使わず、呼び出し側が実際に参照する列だけを取る
+LOAD_PLAYER_SQL = by_placeholder(
+    "SELECT money, endowment, info, choice, submitted, unit, payoff "
+    "FROM players WHERE name = {p} AND class_name = {p}"
+)
+LOAD_GROUP_INFO_SQL = "SELECT value, final_price, round, confirmed, show_result, show_graph FROM group_info WHERE id=1"
+# 清算・管理画面・グラフ共通（class_name は条件そのものなので取らない）
+FETCH_PLAYERS_SQL = by_placeholder(
+    "SELECT id, name, money, endowment, choice, submitted, payoff, info, qty, unit, "
+    + ", ".join(MU_COLS)
+    + " FROM players WHERE class_name = {p}"
+)
+INSERT_PLAYER_SQL = by_placeholder(
+    "INSERT INTO players (name, money, endowment, submitted, info, class_name) "
+    "VALUES ({p}, {p}, {p}, FALSE, {p}, {p})"
+)
+SUBMIT_DECISION_SQL = by_placeholder(
+    "UPDATE players SET choice = {p}, submitted = TRUE, qty = {p}, "
+    + ", ".join(f"{col} = {{p}}" for col in MU_COLS)
+    + " WHERE name = {p} AND class_name = {p}"
+)
+# next_round で同じトランザクションに流す2文（Postgres は ; でつないで1回で送る）
+NEXT_ROUND_SQLS = (
+    "UPDATE group_info SET round = round + 1, final_price = NULL, confirmed = FALSE, show_result = FALSE, show_graph = FALSE",
+    "UPDATE players SET submitted=FALSE, payoff=NULL, unit=NULL, choice=NULL, qty=NULL, "
+    + ", ".join(f"{col}=NULL" for col in MU_COLS),
+)
+# set_payoffs で executemany に渡す（SQLite 専用なので ? で固定）
+UPDATE_PLAYER_RESULT_SQL = "UPDATE players SET unit = ?, money = ?, endowment = ?, payoff = ? WHERE id = ?"
+# Postgres 用: execute_values で全員分を1文の UPDATE ... FROM (VALUES ...) にまとめる
+UPDATE_PLAYER_RESULT_PG_SQL = (
+    "UPDATE players AS pl SET unit = v.unit, money = v.money, endowment = v.endowment, payoff = v.payoff "
+    "FROM (VALUES %s) AS v(unit, money, endowment, payoff, id) WHERE pl.id = v.id"
+)
+INSERT_HISTORY_PG_SQL = (
+    "INSERT INTO player_history (name, round, choice, qty, unit, money, endowment, payoff, info, class_name) "
+    "VALUES %s"
+)
+INSERT_HISTORY_SQL = (
+    "INSERT INTO player_history (name, round, choice, qty, unit, money, endowment, payoff, info, class_name) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
 
 
 # --- 1. データベース・ユーティリティ（接続プール＆release導入） ---
 
+class SqliteConnection(sqlite3.Connection):
+    """SQLite接続。DBの種類とプレースホルダ文字を接続作成時にクラス属性として持たせる"""
+    is_pg = False
+    placeholder = "?"
+
+if psycopg2:
+    class PgConnection(psycopg2.extensions.connection):
+        """Postgres接続（プールが connection_factory として使う）"""
+        is_pg = True
+        placeholder = "%s"
+else:
+    PgConnection = None
+
 @st.cache_resource(show_spinner=False)
 def get_pg_pool():
     """
     Postgres接続プールを作成（存在すれば再利用）。
+    Streamlitはセッションごとに別スレッドで動くため、スレッドセーフなプールを使う。
     """
     db_url = os.environ.get('DATABASE_URL')
-    if not (db_url and psycopg2 and SimpleConnectionPool):
+    if not (db_url and psycopg2 and ThreadedConnectionPool):
         return None
     db_url = db_url.replace("postgres://", "postgresql://", 1)
-    # プランに応じてmaxconnは調整してください
-    return SimpleConnectionPool(minconn=1, maxconn=10, dsn=db_url)
+    # 上限は環境変数 PG_MAXCONN で調整（DB側の接続数上限を超えないように）
+    return ThreadedConnectionPool(
+        minconn=2, maxconn=int(os.environ.get("PG_MAXCONN", "40")), dsn=db_url,
+        connection_factory=PgConnection,
+        # アイドル中に切られた接続を次のクエリまで抱えないよう TCP keepalive を有効にする
+        keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+        application_name="market-exp",
+    )
+
+def open_sqlite_conn():
+    """
+    ローカルSQLite接続を開く（プールに空きがないときだけ呼ばれる）。
+    WAL・synchronous=NORMAL・busy_timeout・キャッシュ・mmap関連のPRAGMAも接続ごとにここで一度だけ設定。
+    """
+    conn = sqlite3.connect("local_market.db", check_same_thread=False, factory=SqliteConnection)
+    conn.row_factory = sqlite3.Row  # 列名アクセス用（接続作成時に一度だけ設定）
+    # SQLite のロック耐性を上げる
+    try:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-20000;")  # 約20MB（負値はKB指定）
+        conn.execute("PRAGMA mmap_size=134217728;")  # 128MB: 読み取りをメモリマップ経由にしてコピーを省く
+    except Exception:
+        pass
+    return conn
+
+class SqlitePool:
+    """
+    SQLite接続の小さなプール（Postgresのプールと同じ getconn / putconn で使う）。
+    使用中の接続は1つの呼び出しだけが持つので、他セッションの書き込み中トランザクションが読み取りに混ざらない。
+    """
+    def __init__(self, maxsize):
+        self._idle = queue.Queue(maxsize)
+
+    def getconn(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return open_sqlite_conn()
+
+    def putconn(self, conn):
+        if conn.in_transaction:
+            conn.rollback()  # 途中のトランザクションを次の利用者に持ち越さない
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@st.cache_resource(show_spinner=False)
+def get_sqlite_pool():
+    """SQLite接続プールを作成（再実行・スレッドをまたいで再利用）"""
+    return SqlitePool(maxsize=8)
+
+# Streamlit はスクリプトを再実行のたびに上から実行し直すため、モジュール変数だけではプールを保持できない。
+# 実体は cache_resource で保持し、ここでは再実行ごとに一度だけ引いておく（DB呼び出しごとのキャッシュ参照を省く）
+PG_POOL = get_pg_pool()
+SQLITE_POOL = None if PG_POOL else get_sqlite_pool()
 
 def connect():
     """
     RenderのPostgreSQLまたはローカルのSQLiteに接続する。
-    PostgreSQL時はプールから取得、SQLite時はWAL+busy_timeoutを設定。
+    どちらもプールから取得する（SQLiteは開いたままの接続を使い回す）。
     """
-    pool = get_pg_pool()
-    if pool:
-        return pool.getconn()
+    if PG_POOL:
+        return PG_POOL.getconn()
     else:
-        conn = sqlite3.connect("local_market.db", check_same_thread=False)
-        # SQLite のロック耐性を上げる
-        try:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA busy_timeout=3000;")
-        except Exception:
-            pass
-        return conn
+        return SQLITE_POOL.getconn()
 
 def release(conn):
     """
-    conn.close() の代わりに呼ぶ。Postgresはプールに返却、SQLiteはclose。
+    conn.close() の代わりに呼ぶ。接続はそれぞれのプールに返却する。
     """
-    pool = get_pg_pool()
-    if pool and psycopg2 and isinstance(conn, psycopg2.extensions.connection):
-        pool.putconn(conn)
+    if conn.is_pg:
+        PG_POOL.putconn(conn)
     else:
-        conn.close()
+        SQLITE_POOL.putconn(conn)
 
 def get_cursor(conn):
-    """DBの種類に応じて適切なカーソルを返す (列名でアクセス可能にする)"""
-    if psycopg2 and isinstance(conn, psycopg2.extensions.connection):
-        return conn.cursor(cursor_factory=DictCursor)
-    else:  # sqlite3.Connection
-        conn.row_factory = sqlite3.Row
+    """DBの種類に応じて適切なカーソルを返す (列名でアクセス可能にする。Postgresは行を素のdictで返す)"""
+    if conn.is_pg:
+        return conn.cursor(cursor_factory=RealDictCursor)
+    else:  # sqlite3.Connection（row_factory は open_sqlite_conn で設定済み）
         return conn.cursor()
 
-def get_placeholder_char(conn):
-    """DBの種類に応じたプレースホルダ文字 (%s or ?) を返す"""
-    return "%s" if psycopg2 and isinstance(conn, psycopg2.extensions.connection) else "?"
-
 def row_to_dict(row):
-    """psycopg2のDictRow / sqlite3.Row を素のdictに正規化"""
+    """psycopg2のRealDictRow / sqlite3.Row を素のdictに正規化"""
     if row is None:
         return None
     try:
@@ -118,6 +236,29 @@ def row_to_dict(row):
 def rows_to_dicts(rows):
     return [row_to_dict(r) for r in rows]
 
+def skip_commit_fsync(conn, c):
+    """
+    Postgresのみ: このトランザクションのCOMMITでWALのfsync完了を待たない。
+    クラッシュ時に直前数msの書き込みを失い得るが、整合性は保たれる（授業用の実験データなので許容）。
+    """
+    if conn.is_pg:
+        c.execute("SET LOCAL synchronous_commit = OFF")
+
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock():
+    """プロセス内で共有する書き込みロック"""
+    return threading.Lock()
+
+def serialized_write(func):
+    """
+    書き込み関数をプロセス内で1つずつ実行するデコレータ。
+    SQLiteは書き込み可能な接続が同時に1つだけなので、ロック待ちをDB側のエラーではなくここで吸収する。
+    """
+    def wrapper(*args, **kwargs):
+        with get_write_lock():
+            return func(*args, **kwargs)
+    return wrapper
 
 def retry_on_db_lock(func):
     """
@@ -139,54 +280,50 @@ def retry_on_db_lock(func):
 
 
 @retry_on_db_lock
+@serialized_write
 def initialize_db():
     """データベースとテーブルを初期化する（インデックス含む）"""
     conn = connect()
     c = get_cursor(conn)
 
-    is_postgres = psycopg2 and isinstance(conn, psycopg2.extensions.connection)
+    is_postgres = conn.is_pg
 
     # データ型と自動インクリメントをDBに合わせて切り替え
     id_type = "SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"
     bool_type = "BOOLEAN" if is_postgres else "INTEGER"
     default_bool = "FALSE" if is_postgres else "0"
 
-    c.execute(f"""
+    # テーブル・初期行・インデックスを1回の送信でまとめて作成する（すべて IF NOT EXISTS / ON CONFLICT で冪等）
+    schema_sql = f"""
         CREATE TABLE IF NOT EXISTS players (
             id {id_type}, name TEXT, money INTEGER,
             endowment INTEGER, choice INTEGER, submitted {bool_type} DEFAULT {default_bool},
             payoff INTEGER, info INTEGER, class_name TEXT, qty INTEGER,
             unit INTEGER, mu1 INTEGER, mu2 INTEGER, mu3 INTEGER, mu4 INTEGER, mu5 INTEGER
-        )
-    """)
-    c.execute(f"""
+        );
         CREATE TABLE IF NOT EXISTS group_info (
             id INTEGER PRIMARY KEY, value INTEGER, final_price INTEGER,
             round INTEGER, confirmed {bool_type} DEFAULT {default_bool}, 
             show_result {bool_type} DEFAULT {default_bool},
             show_graph {bool_type} DEFAULT {default_bool}
-        )
-    """)
-    c.execute(f"""
+        );
         CREATE TABLE IF NOT EXISTS player_history (
             id {id_type}, name TEXT, round INTEGER,
             choice INTEGER, qty INTEGER, unit INTEGER DEFAULT 0, money INTEGER,
             endowment INTEGER, payoff INTEGER, info INTEGER, class_name TEXT
-        )
-    """)
-
-    # group_infoに初期データがない場合のみINSERT
-    c.execute("SELECT id FROM group_info WHERE id = 1")
-    if c.fetchone() is None:
-        c.execute(
-            "INSERT INTO group_info (id, value, round, confirmed, show_result, show_graph) VALUES (1, 100, 1, FALSE, FALSE, FALSE)"
-        )
-
-    # インデックス（Postgres/SQLite共通でIF NOT EXISTS対応）
-    c.execute("CREATE INDEX IF NOT EXISTS idx_players_class ON players(class_name)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_players_class_sub ON players(class_name, submitted)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_player_name_class ON players(name, class_name)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_history_class_round ON player_history(class_name, round)")
+        );
+        INSERT INTO group_info (id, value, round, confirmed, show_result, show_graph)
+            VALUES (1, 100, 1, FALSE, FALSE, FALSE) ON CONFLICT (id) DO NOTHING;
+        -- class_name 単独の索引は (class_name, submitted) の先頭列で代用できるので持たない（書き込みごとの索引更新を減らす）
+        DROP INDEX IF EXISTS idx_players_class;
+        CREATE INDEX IF NOT EXISTS idx_players_class_sub ON players(class_name, submitted);
+        CREATE INDEX IF NOT EXISTS idx_player_name_class ON players(name, class_name);
+        CREATE INDEX IF NOT EXISTS idx_history_class_round ON player_history(class_name, round);
+    """
+    if is_postgres:
+        c.execute(schema_sql)  # psycopg2 は ; 区切りの複数文を1回で送れる
+    else:
+        conn.executescript(schema_sql)  # sqlite3 の execute は1文のみなので executescript を使う
 
     conn.commit()
     release(conn)
@@ -194,180 +331,217 @@ def initialize_db():
 
 # --- 2. データアクセス関数 (読み取り) ---
 
-def load_player(student_id):
+@st.cache_data(ttl=5, show_spinner=False)
+def load_player(student_id, class_name):
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
-    c.execute(f"SELECT * FROM players WHERE name = {p}", (student_id,))
+    c.execute(LOAD_PLAYER_SQL[conn.placeholder], (student_id, class_name))
     result = row_to_dict(c.fetchone())
     release(conn)
     return result
 
-@st.cache_data(ttl=5, show_spinner=False)
+@st.cache_resource(ttl=5, show_spinner=False)
 def load_group_info():
+    """
+    毎回の再実行で読む小さな1行なので、cache_data のようにヒットのたびに複製せず同じオブジェクトを返す。
+    全セッションで共有するため、読み取り専用のビューにして渡す。
+    """
     conn = connect()
     c = get_cursor(conn)
-    c.execute("SELECT * FROM group_info WHERE id=1")
+    c.execute(LOAD_GROUP_INFO_SQL)
     result = row_to_dict(c.fetchone())
     release(conn)
-    return result
+    return MappingProxyType(result) if result is not None else None
+
+def _fetch_players(c, p, class_name):
+    """既に開いているカーソルでクラスの参加者を取得（トランザクション内の読み取り用）"""
+    c.execute(FETCH_PLAYERS_SQL[p], (class_name,))
+    return rows_to_dicts(c.fetchall())
 
 def load_all_players(class_name):
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
-    c.execute(f"SELECT * FROM players WHERE class_name = {p}", (class_name,))
-    results = rows_to_dicts(c.fetchall())
+    results = _fetch_players(c, conn.placeholder, class_name)
     release(conn)
     return results
 
+@st.cache_data(ttl=5, show_spinner=False)
+def cached_players(class_name, round_num, final_price):
+    """
+    表示用の参加者一覧。ラウンドや清算状態が変わるとキーが変わり再取得される。
+    （set_payoffs など書き込み側は常に load_all_players で最新を読む）
+    """
+    return load_all_players(class_name)
+
+def clear_read_caches():
+    """
+    書き込み後に読み取り系キャッシュを破棄する。
+    （st.cache_data は全セッション共有なので、他の参加者・管理者の画面にもすぐ反映される）
+    """
+    load_player.clear()
+    load_group_info.clear()
+    cached_players.clear()
+    cached_curves.clear()
+    history_csv_blob.clear()
+
 
 # --- 3. データアクセス関数 (書き込み) ---
 
+@st.cache_resource(show_spinner=False)
+def get_rng():
+    """NumPy乱数生成器（プロセス内で一つを使い回す）"""
+    return np.random.default_rng()
+
 @retry_on_db_lock
+@serialized_write
 def initialize_player(student_id, class_name):
-    conn = connect()
-    c = get_cursor(conn)
-    
-    c.execute("SELECT value FROM group_info WHERE id=1")
-    row = row_to_dict(c.fetchone())
-    group_value = (row.get('value') if row else 100) or 100
+    # group_info はキャッシュ済みの値を使う（登録時にDBを読みに行かない）
+    group_value = (load_group_info() or {}).get('value') or 100
     prob_val = group_value / 100.0
     endowment = 3 #random.choices([1, 2, 3, 4], weights=[prob_val**3, prob_val**2, prob_val, 1])[0]
     money = INITIAL_MONEY #- ENDOWMENT_MULTIPLIER * endowment
-    info = int(random.expovariate(1 / group_value)) if prob_val > 0 else 0
+    info = int(get_rng().exponential(group_value)) if prob_val > 0 else 0
 
-    p = get_placeholder_char(conn)
-    sql = f"INSERT INTO players (name, money, endowment, submitted, info, class_name) VALUES ({p}, {p}, {p}, FALSE, {p}, {p})"
-    c.execute(sql, (student_id, money, endowment, info, class_name))
+    conn = connect()
+    c = get_cursor(conn)
+    p = conn.placeholder
+    c.execute(INSERT_PLAYER_SQL[p], (student_id, money, endowment, info, class_name))
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 @retry_on_db_lock
+@serialized_write
 def submit_player_decision(player_name, class_name, choice, qty, mu_values):
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
+    p = conn.placeholder
     
     padded_mus = mu_values + [None] * (MAX_UNITS - len(mu_values))
-    mu_columns_update = ', '.join([f"mu{i+1} = {p}" for i in range(MAX_UNITS)])
-    
-    query = f"UPDATE players SET choice = {p}, submitted = TRUE, qty = {p}, {mu_columns_update} WHERE name = {p} AND class_name = {p}"
     params = [choice, qty] + padded_mus + [player_name, class_name]
-    c.execute(query, params)
+    c.execute(SUBMIT_DECISION_SQL[p], params)
     conn.commit()
     release(conn)
-
-def _get_unit_demands(player, price):
-    if player.get("choice") != 1: return 0
-    return sum(1 for i in range(1, MAX_UNITS + 1) if player.get(f"mu{i}") is not None and player.get(f"mu{i}") >= price)
-
-def _get_unit_supplies(player, price):
-    if player.get("choice") != -1: return 0
-    return sum(1 for i in range(1, MAX_UNITS + 1) if player.get(f"mu{i}") is not None and player.get(f"mu{i}") <= price)
+    clear_read_caches()
 
 @retry_on_db_lock
+@serialized_write
 def set_payoffs(group_value, class_name):
-    import numpy as np
     conn = connect()
-    c = get_cursor(conn)
-    p = get_placeholder_char(conn)
-    
-    # 未提出者を不参加（choice=0）として確定
-    c.execute(f"UPDATE players SET choice = 0, qty = 0, submitted = TRUE WHERE submitted = FALSE AND class_name = {p}", (class_name,))
-    conn.commit()
-
-    players = load_all_players(class_name)
-
-    # --- 高速化: 価格探索をヒストグラム×累積和で ---
-    prices_arr, demand_arr, supply_arr = compute_demand_supply_curves_fast(players)
-    trade_volume = np.minimum(demand_arr, supply_arr)
-    price = int(prices_arr[int(np.argmax(trade_volume))]) if len(trade_volume) > 0 else 0
+    try:
+        c = get_cursor(conn)
+        skip_commit_fsync(conn, c)
+        p = conn.placeholder
+        is_pg = conn.is_pg
+
+        # 清算全体を1トランザクションにまとめる（SQLiteは書き込みロックを先に取得）
+        if not is_pg and not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+
+        # 未提出者を不参加（choice=0）として確定
+        c.execute(f"UPDATE players SET choice = 0, qty = 0, submitted = TRUE WHERE submitted = FALSE AND class_name = {p}", (class_name,))
+
+        # 同じトランザクション内で読み直す（別接続だと未コミットの更新が見えない）
+        players = _fetch_players(c, p, class_name)
+
+        # --- 高速化: 価格探索とマッチングを同じソート済み配列で ---
+        buy_mus, buy_ids, sell_mus, sell_ids = _sorted_units(players)
+        price = find_clearing_price(buy_mus[::-1], sell_mus)
+
+        # 成立ユニット: 価格以上の買い（降順の先頭）と価格以下の売り（昇順の先頭）を順に突き合わせる
+        trades = min(int(np.count_nonzero(buy_mus >= price)), int(np.count_nonzero(sell_mus <= price)))
+
+        c.execute("SELECT round FROM group_info WHERE id=1")
+        row = row_to_dict(c.fetchone())
+        round_num = row.get('round') if row else 1
+
+        # 成立数・資産・報酬を列ごとに一括計算（購入は+、売却は−。片側にしか現れないので差を取ればよい）
+        n = len(players)
+        ids = np.fromiter((player["id"] for player in players), dtype=np.int64, count=n)
+        money = np.fromiter((player["money"] for player in players), dtype=np.int64, count=n)
+        endowment = np.fromiter((player["endowment"] for player in players), dtype=np.int64, count=n)
+        max_id = int(ids.max()) if n else 0
+        unit = (np.bincount(buy_ids[:trades], minlength=max_id + 1)[ids]
+                - np.bincount(sell_ids[:trades], minlength=max_id + 1)[ids])
+        money = money - unit * price
+        endowment = endowment + unit
+        payoff = (group_value * endowment + money).astype(np.int64)
+
+        # 更新内容を先にまとめ、executemany で一括反映する
+        results = list(zip(unit.tolist(), money.tolist(), endowment.tolist(), payoff.tolist()))
+        update_rows = [result + (player["id"],) for result, player in zip(results, players)]
+        history_rows = [
+            (player["name"], round_num, player.get("choice"), player.get("qty", 0), u,
+             m, e, pay, player.get("info"), class_name)
+            for (u, m, e, pay), player in zip(results, players)
+        ]
+
+        if is_pg:
+            # 1行ずつ往復せず、1文で全員分を更新・記録する
+            execute_values(c, UPDATE_PLAYER_RESULT_PG_SQL, update_rows)
+            execute_values(c, INSERT_HISTORY_PG_SQL, history_rows)
+        else:
+            # SQLite は同一プロセス内なので executemany で十分（C側でループする）
+            c.executemany(UPDATE_PLAYER_RESULT_SQL, update_rows)
+            c.executemany(INSERT_HISTORY_SQL, history_rows)
 
-    # 成立ユニットをマッチング（priceで閾値）
-    buy_units = sorted(
-        [(player.get(f"mu{i+1}"), player["id"])
-         for player in players if player.get("choice") == 1
-         for i in range(player.get("qty", 0))
-         if player.get(f"mu{i+1}") is not None and player.get(f"mu{i+1}") >= price],
-        reverse=True
-    )
-    sell_units = sorted(
-        [(player.get(f"mu{i+1}"), player["id"])
-         for player in players if player.get("choice") == -1
-         for i in range(player.get("qty", 0))
-         if player.get(f"mu{i+1}") is not None and player.get(f"mu{i+1}") <= price]
+        c.execute(f"UPDATE group_info SET final_price={p}, show_result=TRUE, show_graph=TRUE WHERE id=1", (price,))
+        conn.commit()
+    except Exception:
+        conn.rollback()  # 途中で失敗しても一部だけ反映された状態を残さず、接続をきれいな状態でプールに返す
+        raise
+    finally:
+        release(conn)
+    clear_read_caches()
+
+    # 清算に使ったソート済み配列から曲線を作り、直後の管理画面のグラフ描画で再利用する
+    st.session_state["market_curves"] = (
+        (class_name, round_num, price),
+        _curves_from_sorted(buy_mus[::-1], sell_mus),
     )
-    
-    trades = min(len(buy_units), len(sell_units))
-    matched_buyers, matched_sellers = {}, {}
-    for i in range(trades):
-        buyer_id = buy_units[i][1]
-        seller_id = sell_units[i][1]
-        matched_buyers[buyer_id] = matched_buyers.get(buyer_id, 0) + 1
-        matched_sellers[seller_id] = matched_sellers.get(seller_id, 0) + 1
-
-    c.execute("SELECT round FROM group_info WHERE id=1")
-    row = row_to_dict(c.fetchone())
-    round_num = row.get('round') if row else 1
-
-    for player in players:
-        unit = 0
-        if player.get("choice") == 1:
-            unit = matched_buyers.get(player["id"], 0)
-        elif player.get("choice") == -1:
-            unit = -matched_sellers.get(player["id"], 0)
-
-        money = player["money"] - unit * price
-        endowment = player["endowment"] + unit
-        payoff = int(group_value * endowment + money)
-
-        c.execute(f"UPDATE players SET unit = {p}, money = {p}, endowment = {p}, payoff = {p} WHERE id = {p}",
-                  (unit, money, endowment, payoff, player["id"]))
-        c.execute(
-            f"INSERT INTO player_history (name, round, choice, qty, unit, money, endowment, payoff, info, class_name) "
-            f"VALUES ({p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p})",
-            (player["name"], round_num, player.get("choice"), player.get("qty", 0), unit,
-             money, endowment, payoff, player.get("info"), player.get("class_name"))
-        )
-
-    c.execute(f"UPDATE group_info SET final_price={p}, show_result=TRUE, show_graph=TRUE WHERE id=1", (price,))
-    conn.commit()
-    release(conn)
     return price
 
 @retry_on_db_lock
+@serialized_write
 def next_round():
     conn = connect()
     c = get_cursor(conn)
-    c.execute("UPDATE group_info SET round = round + 1, final_price = NULL, confirmed = FALSE, show_result = FALSE, show_graph = FALSE")
-    c.execute("UPDATE players SET submitted=FALSE, payoff=NULL, unit=NULL, choice=NULL, qty=NULL, mu1=NULL, mu2=NULL, mu3=NULL, mu4=NULL, mu5=NULL")
+    skip_commit_fsync(conn, c)
+    if conn.is_pg:
+        c.execute(";\n".join(NEXT_ROUND_SQLS))  # 2文を1往復で送る
+    else:
+        for sql in NEXT_ROUND_SQLS:  # sqlite3 の execute は1文ずつ（executescript は途中でCOMMITしてしまう）
+            c.execute(sql)
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 @retry_on_db_lock
+@serialized_write
 def confirm_results():
     conn = connect()
     c = get_cursor(conn)
     c.execute("UPDATE group_info SET confirmed = TRUE WHERE id=1")
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 @retry_on_db_lock
-def reset_experiment():
+@serialized_write
+def reset_experiment(class_name):
     new_value = random.randint(80, 200)
     conn = connect()
     c = get_cursor(conn)
-    if psycopg2 and isinstance(conn, psycopg2.extensions.connection):
-        c.execute("TRUNCATE TABLE players, player_history RESTART IDENTITY")
-    else:
-        c.execute("DELETE FROM players")
-        c.execute("DELETE FROM player_history")  # SQLite does not support TRUNCATE on multiple tables
-    
-    p = get_placeholder_char(conn)
+    skip_commit_fsync(conn, c)
+    p = conn.placeholder
+    # 対象クラスの行だけ削除する（他クラスのデータとテーブル全体のロックには触れない）
+    c.execute(f"DELETE FROM players WHERE class_name = {p}", (class_name,))
+    c.execute(f"DELETE FROM player_history WHERE class_name = {p}", (class_name,))
+    # group_info は全クラス共有の1行なので、ラウンド・価値などの進行状態は全クラス分まとめて初期化される
     c.execute(f"UPDATE group_info SET final_price=NULL, round=1, value={p}, confirmed=FALSE, show_result=FALSE, show_graph=FALSE", (new_value,))
     conn.commit()
     release(conn)
+    clear_read_caches()
     if "student_id" in st.session_state:
         del st.session_state["student_id"]
 
@@ -376,36 +550,81 @@ def reset_experiment():
 
 def compute_demand_supply_curves_fast(players):
     """
-    各価格での需要・供給本数をヒストグラム＋累積和で計算（O(N×U + 価格数)）
-    """
-    import numpy as np
-    buy_hist  = np.zeros(MAX_PRICE + 1, dtype=np.int32)
-    sell_hist = np.zeros(MAX_PRICE + 1, dtype=np.int32)
-
-    for p in players:
-        qty = int(p.get("qty") or 0)
-        ch  = p.get("choice")
-        if ch == 1:  # 購入
-            for i in range(1, qty + 1):
-                mu = p.get(f"mu{i}")
-                if mu is not None:
-                    buy_hist[int(mu)] += 1
-        elif ch == -1:  # 売却
-            for i in range(1, qty + 1):
-                mu = p.get(f"mu{i}")
-                if mu is not None:
-                    sell_hist[int(mu)] += 1
-
-    # 需要: mu >= price → 右からの累積和
-    demand = buy_hist[::-1].cumsum()[::-1]
-    # 供給: mu <= price → 左からの累積和
-    supply = sell_hist.cumsum()
+    各価格での需要・供給本数を、ソート済み評価額への二分探索で一括計算（O(K log K + 価格数)）
+    """
+    return _curves_from_sorted(*_sorted_unit_mus(players))
 
+def _curves_from_sorted(buy_mus, sell_mus):
+    """昇順の購入・売却評価額から、全価格の需要・供給本数を求める"""
     prices = np.arange(MAX_PRICE + 1)
+
+    # 需要: mu >= price の本数
+    demand = len(buy_mus) - np.searchsorted(buy_mus, prices, side="left")
+    # 供給: mu <= price の本数
+    supply = np.searchsorted(sell_mus, prices, side="right")
     return prices, demand, supply
 
-def plot_market_curves_from_arrays(prices, demand, supply, final_price=None):
+def players_to_arrays(players):
+    """
+    参加者リスト(dictの配列)を列ごとのNumPy配列に変換する。
+    戻り値: ids, choice, qty, mus (mus は N×MAX_UNITS、未入力は -1)
+    """
+    n = len(players)
+    ids = np.fromiter((p["id"] for p in players), dtype=np.int64, count=n)
+    choice = np.fromiter((p.get("choice") or 0 for p in players), dtype=np.int8, count=n)
+    qty = np.fromiter((p.get("qty") or 0 for p in players), dtype=np.int16, count=n)
+    # 列ごとの dict 参照をせず行単位のタプルで受け取る。未入力(None)は float 化で NaN になるので一括で -1 に
+    mus = np.array([get_mus(p) for p in players], dtype=np.float64).reshape(n, MAX_UNITS)
+    mus = np.nan_to_num(mus, nan=-1).astype(np.int32)
+    return ids, choice, qty, mus
+
+def _sorted_units(players):
+    """
+    購入ユニットを評価額の高い順、売却ユニットを低い順に並べ、
+    (buy_mus, buy_ids, sell_mus, sell_ids) を返す。
+    同じ評価額では購入はID降順、売却はID昇順（(評価額, ID) タプルのソートと同じ順序）。
+    """
+    ids, choice, qty, mus = players_to_arrays(players)
+    # 有効なユニット: qty 個目まで、かつ評価額が入力済み
+    valid = (np.arange(MAX_UNITS) < qty[:, None]) & (mus >= 0)
+    owners = np.broadcast_to(ids[:, None], mus.shape)
+    buy_mask = valid & (choice == 1)[:, None]
+    sell_mask = valid & (choice == -1)[:, None]
+    buy_mus, buy_ids = mus[buy_mask], owners[buy_mask]
+    sell_mus, sell_ids = mus[sell_mask], owners[sell_mask]
+    buy_order = np.lexsort((buy_ids, buy_mus))[::-1]
+    sell_order = np.lexsort((sell_ids, sell_mus))
+    return buy_mus[buy_order], buy_ids[buy_order], sell_mus[sell_order], sell_ids[sell_order]
+
+def _sorted_unit_mus(players):
+    """購入・売却ユニットの評価額を、それぞれ昇順のNumPy配列で返す"""
+    buy_mus, _, sell_mus, _ = _sorted_units(players)
+    return buy_mus[::-1], sell_mus
+
+def find_clearing_price(buy_mus, sell_mus):
+    """
+    取引量 min(需要, 供給) を最大にする最小の価格を返す（O(K log K)）。
+    供給が増えるのは売り手の評価額の位置だけなので、候補は 0 と各売り評価額に絞れる。
+    """
+    if len(buy_mus) == 0 or len(sell_mus) == 0:
+        return 0  # 片側が空なら全価格で取引量0（最小価格 0 を採用）
+    candidates = np.unique(np.concatenate(([0], sell_mus)))
+    candidates = candidates[candidates <= MAX_PRICE]
+    demand = len(buy_mus) - np.searchsorted(buy_mus, candidates, side="left")
+    supply = np.searchsorted(sell_mus, candidates, side="right")
+    return int(candidates[int(np.argmax(np.minimum(demand, supply)))])
+
+def get_pyplot():
+    """
+    pyplot を遅延読み込みする。描画はPNGに書き出すだけなので、GUIを持たない Agg バックエンドに固定する。
+    """
+    import matplotlib
+    matplotlib.use("Agg")
     import matplotlib.pyplot as plt
+    return plt
+
+def plot_market_curves_from_arrays(prices, demand, supply, final_price=None):
+    plt = get_pyplot()
     fig, ax = plt.subplots()
     ax.plot(demand, prices, label="Demand", drawstyle="steps-post")
     ax.plot(supply, prices, label="Supply", drawstyle="steps-post")
@@ -418,23 +637,60 @@ def plot_market_curves_from_arrays(prices, demand, supply, final_price=None):
     ax.grid(True)
     return fig
 
-@st.cache_data(show_spinner=False, ttl=5)
-def cached_curves(class_name):
-    players = load_all_players(class_name)
-    prices, demand, supply = compute_demand_supply_curves_fast(players)
-    # numpy配列はそのまま返せないのでlist化
-    return prices.tolist(), demand.tolist(), supply.tolist()
-
-def render_market_graph(class_name, final_price=None):
-    import numpy as np
+@st.cache_data(show_spinner=False, max_entries=32)
+def market_png(prices, demand, supply, final_price=None):
+    """
+    需給曲線(NumPy配列)をキーに描画済みPNGをキャッシュ。同じ曲線なら再描画しない。
+    """
+    plt = get_pyplot()
+    fig = plot_market_curves_from_arrays(prices, demand, supply, final_price)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight", dpi=110)
+    plt.close(fig)
+    return buf.getvalue()
+
+@st.cache_resource(show_spinner=False, ttl=5)
+def cached_curves(class_name, round_num, final_price):
+    """
+    需給曲線を NumPy 配列のまま共有する（cache_data と違い、ヒットのたびに複製・直列化しない）。
+    全セッションで同じ配列を使うので読み取り専用にしておく。
+    """
+    players = cached_players(class_name, round_num, final_price)
+    curves = compute_demand_supply_curves_fast(players)
+    for a in curves:
+        a.setflags(write=False)
+    return curves
 
-    prices, demand, supply = cached_curves(class_name)
-    fig = plot_market_curves_from_arrays(np.array(prices), np.array(demand), np.array(supply), final_price)
-    st.pyplot(fig)
+def render_market_graph(class_name, round_num, final_price=None, players=None):
+    """
+    清算直後は set_payoffs が残した曲線を再利用し、
+    players を渡された場合（管理画面）は読み込み済みの一覧から直接曲線を計算する
+    """
+    shared = st.session_state.get("market_curves")
+    if shared and shared[0] == (class_name, round_num, final_price):
+        prices, demand, supply = shared[1]
+    elif players is not None:
+        prices, demand, supply = compute_demand_supply_curves_fast(players)
+    else:
+        prices, demand, supply = cached_curves(class_name, round_num, final_price)
+    st.image(market_png(prices, demand, supply, final_price))
 
 
 # --- 5. UIコンポーネント ---
 
+def group_state(group_info):
+    """プレイヤー画面の表示を左右する group_info の値"""
+    return tuple(group_info.get(k) for k in ("round", "show_result", "show_graph", "final_price", "confirmed"))
+
+@st.fragment(run_every=PLAYER_POLL_SECONDS)
+def wait_for_group_change(state):
+    """
+    待機中のプレイヤー画面で group_info だけを定期的に確認する。
+    状態が変わったときだけページ全体を再実行する（それ以外はこの断片だけが再実行される）。
+    """
+    if group_state(load_group_info()) != state:
+        st.rerun()
+
 def show_player_ui(class_name):
     st.subheader("プレイヤーログイン")
     student_id = st.text_input("学籍番号を入力してください", st.session_state.get("student_id", ""))
@@ -444,13 +700,12 @@ def show_player_ui(class_name):
         return
 
     st.session_state.student_id = student_id
-    ensure_db()
-    player = load_player(student_id)
+    player = load_player(student_id, class_name)
     group_info = load_group_info()
 
     if player and st.query_params.get("id") != student_id:
-        st.query_params["id"] = student_id   # 1.30+（これでURLが更新されて再実行されます）
-        st.rerun()
+        # URLを書き換えるだけ（読み込み済みの player / group_info で描画を続けるので再実行は不要）
+        st.query_params["id"] = student_id
 
     if not player:
         if group_info.get('confirmed'):
@@ -471,9 +726,8 @@ def show_player_ui(class_name):
     # 1. 提出済みで、結果待ちの状態 (手動更新)
     if player['submitted'] and not group_info.get('show_result'):
         st.info("あなたの決定は提出済みです。管理者が市場を清算するまでお待ちください。")
-        if st.button("結果を更新する", type="primary"):
-            st.rerun()
-        st.info("管理者が操作した後、上のボタンを押すと結果が表示されます。")
+        st.info("管理者が操作すると、結果が自動で表示されます。")
+        wait_for_group_change(group_state(group_info))
 
     # 2. 結果表示の状態
     elif group_info.get('show_result'):
@@ -488,7 +742,7 @@ def show_player_ui(class_name):
         else: st.info("あなたの注文は成立しませんでした。")
 
         if group_info.get('show_graph'):
-            render_market_graph(class_name, final_price)
+            render_market_graph(class_name, group_info.get('round'), final_price)
 
         if group_info.get('confirmed'):
             st.subheader("🎉 最終結果")
@@ -498,67 +752,74 @@ def show_player_ui(class_name):
             st.info("管理者が報酬を確定するまでお待ちください。")
         
         st.info("管理者が次のラウンドを開始するまでお待ちください...")
-        if st.button("状況を更新する"):
-            st.rerun()
+        wait_for_group_change(group_state(group_info))
 
     # 3. 未提出の状態
     else:
         st.header("🛒 取引入力")
+        order_input(student_id, class_name, player['endowment'])
 
-        # --- Step 1: 取引種別と数量（ここは再実行されますが1回だけ想定） ---
-        trade_type = st.radio("取引の種類を選択:", ["購入", "売却"], horizontal=True, key="trade_type")
 
-        if trade_type == "購入":
-            qty_limit = MAX_UNITS
-            st.subheader("📥 購入希望の入力")
-        else:
-            if player['endowment'] == 0:
-                st.warning("売却できる商品がありません。")
-                return
-            qty_limit = player['endowment']
-            st.subheader("📤 売却希望の入力")
-
-        max_qty = st.slider(
-            "数量を決めてください（次のステップで各個の評価額を入力）",
-            0, qty_limit, min(qty_limit, st.session_state.get("max_qty", 0)),
-            key="max_qty"
-        )
+@st.fragment
+def order_input(student_id, class_name, endowment):
+    """
+    取引種別・数量・評価額の入力。ウィジェット操作ではこの断片だけが再実行され、
+    参加者・group_info の読み込みを含むページ全体は再実行しない（提出時のみ全体を再実行）。
+    """
+    # --- Step 1: 取引種別と数量（操作するとこの断片だけが再実行される） ---
+    trade_type = st.radio("取引の種類を選択:", ["購入", "売却"], horizontal=True, key="trade_type")
 
-        # --- Step 2: フォームで“まとめて”入力（ここではスライダーを動かしても再実行されません） ---
-        if max_qty > 0:
-            with st.form("order_form", clear_on_submit=False):
-                st.caption("各個の評価額（購入なら『支払ってよい上限』、売却なら『最低売りたい価格』）")
-                mu_values = []
-                # trade_typeごとに別キーにして衝突回避
-                mu_key_prefix = "buy_mu_" if trade_type == "購入" else "sell_loss_"
-                default_val = 100
-
-                for i in range(1, max_qty + 1):
-                    key = f"{mu_key_prefix}{i}"
-                    val = st.slider(
-                        f"{i}個目の評価額", 0, MAX_PRICE,
-                        value=st.session_state.get(key, default_val),
-                        key=key
-                    )
-                    mu_values.append(val)
-
-                submitted = st.form_submit_button("決定を提出する", type="primary")
-
-            # --- Step 3: 送信時だけDBを書き、再実行（=画面更新） ---
-            if submitted:
-                choice = 1 if trade_type == "購入" else -1
-                submit_player_decision(student_id, class_name, choice, len(mu_values), mu_values)
-                st.success("提出しました！")
-                time.sleep(0.5)
-                st.rerun()
+    if trade_type == "購入":
+        qty_limit = MAX_UNITS
+        st.subheader("📥 購入希望の入力")
+    else:
+        if endowment == 0:
+            st.warning("売却できる商品がありません。")
+            return
+        qty_limit = endowment
+        st.subheader("📤 売却希望の入力")
+
+    max_qty = st.slider(
+        "数量を決めてください（次のステップで各個の評価額を入力）",
+        0, qty_limit, min(qty_limit, st.session_state.get("max_qty", 0)),
+        key="max_qty"
+    )
+
+    # --- Step 2: フォームで“まとめて”入力（ここではスライダーを動かしても再実行されません） ---
+    if max_qty > 0:
+        with st.form("order_form", clear_on_submit=False):
+            st.caption("各個の評価額（購入なら『支払ってよい上限』、売却なら『最低売りたい価格』）")
+            mu_values = []
+            # trade_typeごとに別キーにして衝突回避
+            mu_key_prefix = "buy_mu_" if trade_type == "購入" else "sell_loss_"
+            default_val = 100
+
+            for i in range(1, max_qty + 1):
+                key = f"{mu_key_prefix}{i}"
+                val = st.slider(
+                    f"{i}個目の評価額", 0, MAX_PRICE,
+                    value=st.session_state.get(key, default_val),
+                    key=key
+                )
+                mu_values.append(val)
+
+            submitted = st.form_submit_button("決定を提出する", type="primary")
+
+        # --- Step 3: 送信時だけDBを書き、再実行（=画面更新） ---
+        if submitted:
+            choice = 1 if trade_type == "購入" else -1
+            submit_player_decision(student_id, class_name, choice, len(mu_values), mu_values)
+            st.success("提出しました！")
+            time.sleep(0.5)
+            st.rerun()  # 断片内でも既定でページ全体を再実行し、提出済みの表示に切り替える
 
 
 def show_admin_ui(class_name):
+    import pandas as pd  # 管理画面でしか使わないので、起動時には読み込まない
     st.header(f"🔐 管理者モード (クラス: {class_name})")
-    ensure_db()
 
     group_info = load_group_info()
-    players = load_all_players(class_name)
+    players = cached_players(class_name, group_info.get('round'), group_info.get('final_price'))
     submitted_players = [p for p in players if p.get("submitted")]
 
     st.subheader("現在の状況")
@@ -598,41 +859,56 @@ def show_admin_ui(class_name):
 
     st.subheader("📊 リアルタイムデータ")
     if players:
-        render_market_graph(class_name, final_price)
-        df_players = pd.DataFrame(players)
-        # DataFrameの列を整形
+        render_market_graph(class_name, group_info.get('round'), final_price, players=players)
+        # 表示する列だけで DataFrame を作る（mu列などを一度作ってから捨てない）
         display_cols = ['name', 'choice', 'qty', 'unit', 'money', 'endowment', 'payoff', 'info', 'submitted']
-        st.dataframe(df_players[[col for col in display_cols if col in df_players.columns]], use_container_width=True)
+        st.dataframe(pd.DataFrame(players, columns=display_cols), use_container_width=True)
     else:
         st.info("まだ参加者がいません。")
 
     st.sidebar.header("実験制御")
     if st.sidebar.button("🔄 画面を更新"):
         st.rerun()
-    if st.sidebar.button("⚠️ 実験をリセット", help="すべてのデータが削除されます！"):
-        reset_experiment()
+    if st.sidebar.button("⚠️ 実験をリセット", help="このクラスの参加者と履歴がすべて削除されます！ラウンド・価値・清算状態は全クラス共有のため、他のクラスの分も初期化されます。"):
+        reset_experiment(class_name)
         st.sidebar.success("実験をリセットしました。")
         time.sleep(1)
         st.rerun()
     
     st.sidebar.header("📦 履歴ダウンロード")
-    st.sidebar.download_button(
-        "履歴CSVをダウンロード",
-        data=history_csv_blob(class_name),
-        file_name=f"history_{class_name}_{time.strftime('%Y%m%d')}.csv",
-        mime="text/csv"
-    )
+    # 履歴の読み出しは要求されたときだけ（毎回の再実行で履歴全体を読まない）
+    if st.sidebar.button("履歴CSVを作成"):
+        st.sidebar.download_button(
+            "履歴CSVをダウンロード",
+            data=history_csv_blob(class_name),
+            file_name=f"history_{class_name}_{time.strftime('%Y%m%d')}.csv",
+            mime="text/csv"
+        )
 
 
 # --- 6. 補助: 履歴CSVのキャッシュ ---
 
 @st.cache_data(show_spinner=False, ttl=30)
 def history_csv_blob(class_name):
+    """DataFrameを経由せず、カーソルから直接CSVに書き出す（Postgresはサーバー側で COPY）"""
     conn = connect()
-    p = get_placeholder_char(conn)
-    df = pd.read_sql_query(f"SELECT * FROM player_history WHERE class_name = {p}", conn, params=(class_name,))
-    release(conn)
-    return df.to_csv(index=False).encode("utf-8")
+    c = conn.cursor()  # 行を値の並びのまま書き出すので、dict を返すカーソルは使わない
+    p = conn.placeholder
+    query = f"SELECT * FROM player_history WHERE class_name = {p} ORDER BY id"
+    try:
+        if conn.is_pg:
+            # COPY はパラメータを取れないので mogrify で値を埋め込んだ文を渡す
+            buf = io.BytesIO()
+            c.copy_expert(f"COPY ({c.mogrify(query, (class_name,)).decode()}) TO STDOUT WITH CSV HEADER", buf)
+            return buf.getvalue()
+        c.execute(query, (class_name,))
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow([d[0] for d in c.description])
+        writer.writerows(c)
+        return buf.getvalue().encode("utf-8")
+    finally:
+        release(conn)
 
 
 # --- 7. メイン処理（DB初期化は一度だけ） ---
@@ -647,6 +923,7 @@ def main():
     st.title("ようこそ、市場実験へ！")
 
     # DBが存在しない場合、この時点で初期化（1回のみ）
+    ensure_db()
 
     query_params = st.query_params
     class_name = query_params.get("class")
@@ -4,19 +4,24 @@
 
 # --- 0. Imports & Constants ---
 import streamlit as st
-import pandas as pd
+import numpy as np
 import os
 import random
 import time
+import threading
+import io
+import queue
+import csv
+from types import MappingProxyType
 
 try:
     import psycopg2
-    from psycopg2.extras import DictCursor
-    from psycopg2.pool import SimpleConnectionPool
+    from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
 except ImportError:
     psycopg2 = None
-    DictCursor = None
-    SimpleConnectionPool = None
+    RealDictCursor = None
+    ThreadedConnectionPool = None
 
 import sqlite3
 
@@ -25,7 +30,7 @@ import sqlite3
 # requirements.txt:
 #   streamlit, pandas, matplotlib, numpy, psycopg2-binary
 # 環境変数:
-#   DATABASE_URL (Postgres URL), ADMIN_PW (管理者パスワード)
+#   DATABASE_URL (Postgres URL), ADMIN_PW (管理者パスワード), PG_MAXCONN (任意: 接続プール上限、既定40)
 # DATABASE_URL がなければローカルSQLite (local_lemon_market.db) を使用。
 # ----------------------------------------------------
 
@@ -38,52 +43,107 @@ LEMON_SELLER_VALUE = 20  # ポンコツ: 売り手の評価額
 LEMON_BUYER_VALUE = 30   # ポンコツ: 買い手の評価額
 MAX_PRICE = 100
 TOTAL_ROUNDS = 2
+PLAYER_POLL_SECONDS = 3  # 待機中のプレイヤー画面が lemon_group_info を確認する間隔(秒)
 DB_FILE = "local_lemon_market.db"
 
 
 # --- 1. DB ユーティリティ ---
 
+class SqliteConnection(sqlite3.Connection):
+    # DBの種類とプレースホルダ文字は接続のクラス属性で持つ（呼び出しごとに isinstance しない）
+    is_pg = False
+    placeholder = "?"
+
+
+if psycopg2:
+    class PgConnection(psycopg2.extensions.connection):
+        is_pg = True
+        placeholder = "%s"
+else:
+    PgConnection = None
+
+
 @st.cache_resource(show_spinner=False)
 def get_pg_pool():
     db_url = os.environ.get('DATABASE_URL')
-    if not (db_url and psycopg2 and SimpleConnectionPool):
+    if not (db_url and psycopg2 and ThreadedConnectionPool):
         return None
     db_url = db_url.replace("postgres://", "postgresql://", 1)
-    return SimpleConnectionPool(minconn=1, maxconn=10, dsn=db_url)
+    return ThreadedConnectionPool(
+        minconn=2, maxconn=int(os.environ.get("PG_MAXCONN", "40")), dsn=db_url,
+        connection_factory=PgConnection,
+        keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,  # アイドル切断対策
+        application_name="lemon-market-exp",
+    )
 
 
-def connect():
-    pool = get_pg_pool()
-    if pool:
-        return pool.getconn()
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+def open_sqlite_conn():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, factory=SqliteConnection)
+    conn.row_factory = sqlite3.Row  # 列名アクセス用（接続作成時に一度だけ設定）
     try:
         conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA busy_timeout=3000;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-20000;")  # 約20MB（負値はKB指定）
+        conn.execute("PRAGMA mmap_size=134217728;")  # 128MB: 読み取りをメモリマップ経由にしてコピーを省く
     except Exception:
         pass
     return conn
 
 
+class SqlitePool:
+    # SQLite接続の小さなプール（Postgresのプールと同じ getconn / putconn で使う）。
+    # 使用中の接続は1つの呼び出しだけが持つ（他セッションの書き込み中トランザクションを読み取りに混ぜない）
+    def __init__(self, maxsize):
+        self._idle = queue.Queue(maxsize)
+
+    def getconn(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return open_sqlite_conn()
+
+    def putconn(self, conn):
+        if conn.in_transaction:
+            conn.rollback()  # 途中のトランザクションを次の利用者に持ち越さない
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@st.cache_resource(show_spinner=False)
+def get_sqlite_pool():
+    return SqlitePool(maxsize=8)
+
+
+# プールの実体は cache_resource が保持する（スクリプトは再実行ごとに上から実行し直されるため）。
+# ここでは再実行ごとに一度だけ引き、DB呼び出しのたびにキャッシュを参照しない
+PG_POOL = get_pg_pool()
+SQLITE_POOL = None if PG_POOL else get_sqlite_pool()
+
+
+def connect():
+    if PG_POOL:
+        return PG_POOL.getconn()
+    return SQLITE_POOL.getconn()
+
+
 def release(conn):
-    pool = get_pg_pool()
-    if pool and psycopg2 and isinstance(conn, psycopg2.extensions.connection):
-        pool.putconn(conn)
+    # どちらも閉じずにプールへ返す
+    if conn.is_pg:
+        PG_POOL.putconn(conn)
     else:
-        conn.close()
+        SQLITE_POOL.putconn(conn)
 
 
 def get_cursor(conn):
-    if psycopg2 and isinstance(conn, psycopg2.extensions.connection):
-        return conn.cursor(cursor_factory=DictCursor)
-    conn.row_factory = sqlite3.Row
+    if conn.is_pg:
+        return conn.cursor(cursor_factory=RealDictCursor)
     return conn.cursor()
 
 
-def get_placeholder_char(conn):
-    return "%s" if psycopg2 and isinstance(conn, psycopg2.extensions.connection) else "?"
-
-
 def row_to_dict(row):
     if row is None:
         return None
@@ -100,6 +160,25 @@ def rows_to_dicts(rows):
     return [row_to_dict(r) for r in rows]
 
 
+def skip_commit_fsync(conn, c):
+    # Postgresのみ: このトランザクションのCOMMITでWALのfsyncを待たない（直前数msの取りこぼしは許容）
+    if conn.is_pg:
+        c.execute("SET LOCAL synchronous_commit = OFF")
+
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock():
+    return threading.Lock()
+
+
+def serialized_write(func):
+    # 書き込みはプロセス内で1つずつ（SQLiteのロック待ちをDBエラーにしない）
+    def wrapper(*args, **kwargs):
+        with get_write_lock():
+            return func(*args, **kwargs)
+    return wrapper
+
+
 def retry_on_db_lock(func):
     def wrapper(*args, **kwargs):
         try:
@@ -116,15 +195,17 @@ def retry_on_db_lock(func):
 # --- 2. DB初期化 ---
 
 @retry_on_db_lock
+@serialized_write
 def initialize_db():
     conn = connect()
     c = get_cursor(conn)
-    is_postgres = psycopg2 and isinstance(conn, psycopg2.extensions.connection)
+    is_postgres = conn.is_pg
     id_type = "SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"
     bool_type = "BOOLEAN" if is_postgres else "INTEGER"
     default_bool = "FALSE" if is_postgres else "0"
 
-    c.execute(f"""
+    # テーブル・初期行・インデックスを1回でまとめて作成（IF NOT EXISTS / ON CONFLICT で冪等）
+    schema_sql = f"""
         CREATE TABLE IF NOT EXISTS lemon_players (
             id {id_type},
             name TEXT,
@@ -138,9 +219,7 @@ def initialize_db():
             unit INTEGER DEFAULT 0,
             bought_type TEXT,
             payoff INTEGER
-        )
-    """)
-    c.execute(f"""
+        );
         CREATE TABLE IF NOT EXISTS lemon_group_info (
             id INTEGER PRIMARY KEY,
             round INTEGER,
@@ -148,9 +227,7 @@ def initialize_db():
             confirmed {bool_type} DEFAULT {default_bool},
             show_result {bool_type} DEFAULT {default_bool},
             show_graph {bool_type} DEFAULT {default_bool}
-        )
-    """)
-    c.execute(f"""
+        );
         CREATE TABLE IF NOT EXISTS lemon_player_history (
             id {id_type},
             name TEXT,
@@ -163,20 +240,19 @@ def initialize_db():
             unit INTEGER,
             bought_type TEXT,
             money INTEGER
-        )
-    """)
-
-    c.execute("SELECT id FROM lemon_group_info WHERE id = 1")
-    if c.fetchone() is None:
-        c.execute(
-            "INSERT INTO lemon_group_info (id, round, confirmed, show_result, show_graph) "
-            "VALUES (1, 1, FALSE, FALSE, FALSE)"
-        )
-
-    c.execute("CREATE INDEX IF NOT EXISTS idx_lp_class ON lemon_players(class_name)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_lp_class_sub ON lemon_players(class_name, submitted)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_lp_name_class ON lemon_players(name, class_name)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_lh_class_round ON lemon_player_history(class_name, round)")
+        );
+        INSERT INTO lemon_group_info (id, round, confirmed, show_result, show_graph)
+            VALUES (1, 1, FALSE, FALSE, FALSE) ON CONFLICT (id) DO NOTHING;
+        -- class_name 単独の索引は (class_name, submitted) で代用できるので持たない
+        DROP INDEX IF EXISTS idx_lp_class;
+        CREATE INDEX IF NOT EXISTS idx_lp_class_sub ON lemon_players(class_name, submitted);
+        CREATE INDEX IF NOT EXISTS idx_lp_name_class ON lemon_players(name, class_name);
+        CREATE INDEX IF NOT EXISTS idx_lh_class_round ON lemon_player_history(class_name, round);
+    """
+    if is_postgres:
+        c.execute(schema_sql)
+    else:
+        conn.executescript(schema_sql)  # sqlite3 の execute は1文のみ
 
     conn.commit()
     release(conn)
@@ -184,10 +260,11 @@ def initialize_db():
 
 # --- 3. データアクセス (読み取り) ---
 
+@st.cache_data(ttl=5, show_spinner=False)
 def load_player(student_id, class_name):
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
+    p = conn.placeholder
     c.execute(
         f"SELECT * FROM lemon_players WHERE name = {p} AND class_name = {p}",
         (student_id, class_name)
@@ -197,35 +274,49 @@ def load_player(student_id, class_name):
     return result
 
 
-@st.cache_data(ttl=5, show_spinner=False)
+@st.cache_resource(ttl=5, show_spinner=False)
 def load_group_info():
+    # ヒットのたびに複製しないよう cache_resource で共有する（共有物なので読み取り専用ビューで返す）
     conn = connect()
     c = get_cursor(conn)
     c.execute("SELECT * FROM lemon_group_info WHERE id=1")
     result = row_to_dict(c.fetchone())
     release(conn)
-    return result
+    return MappingProxyType(result) if result is not None else None
+
+
+def _fetch_players(c, p, class_name):
+    # 既に開いているカーソルで読む（トランザクション内の読み取り用）
+    c.execute(f"SELECT * FROM lemon_players WHERE class_name = {p}", (class_name,))
+    return rows_to_dicts(c.fetchall())
 
 
 def load_all_players(class_name):
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
-    c.execute(f"SELECT * FROM lemon_players WHERE class_name = {p}", (class_name,))
-    results = rows_to_dicts(c.fetchall())
+    results = _fetch_players(c, conn.placeholder, class_name)
     release(conn)
     return results
 
 
+def clear_read_caches():
+    # 書き込み後に読み取りキャッシュを破棄（全セッション共有なので他の画面にもすぐ反映される）
+    load_player.clear()
+    load_group_info.clear()
+    cached_curves.clear()
+    history_csv_blob.clear()
+
+
 # --- 4. データアクセス (書き込み) ---
 
 @retry_on_db_lock
+@serialized_write
 def initialize_player(student_id, class_name):
     """登録時に乱数で半数に車を配り、車のタイプ(良/ポンコツ)も乱数で決める。
     DBに保存されるので、離脱して再ログインしても同じ役割が維持される。"""
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
+    p = conn.placeholder
 
     has_car = random.random() < 0.5
     if has_car:
@@ -241,13 +332,15 @@ def initialize_player(student_id, class_name):
     c.execute(sql, (student_id, class_name, INITIAL_MONEY, has_car, car_type))
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 
 @retry_on_db_lock
+@serialized_write
 def submit_player_decision(player_name, class_name, price):
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
+    p = conn.placeholder
     sql = (
         f"UPDATE lemon_players SET bid_or_ask = {p}, submitted = TRUE "
         f"WHERE name = {p} AND class_name = {p}"
@@ -255,6 +348,7 @@ def submit_player_decision(player_name, class_name, price):
     c.execute(sql, (price, player_name, class_name))
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 
 # --- 5. 需給曲線計算 ---
@@ -264,7 +358,6 @@ def compute_demand_supply_curves(players):
     買い手: bid_or_ask は最高買い値(bid)。需要 = bid >= price の人数。
     売り手: bid_or_ask は最低売り値(ask)。供給 = ask <= price の人数。
     """
-    import numpy as np
     buy_hist = np.zeros(MAX_PRICE + 1, dtype=np.int32)
     sell_hist = np.zeros(MAX_PRICE + 1, dtype=np.int32)
 
@@ -291,128 +384,146 @@ def compute_demand_supply_curves(players):
 # --- 6. 市場清算 ---
 
 @retry_on_db_lock
+@serialized_write
 def clear_market(class_name):
     """市場を清算する。需給の交点で価格を決定 → マッチング → DB更新。"""
-    import numpy as np
     conn = connect()
-    c = get_cursor(conn)
-    p = get_placeholder_char(conn)
+    try:
+        c = get_cursor(conn)
+        skip_commit_fsync(conn, c)
+        p = conn.placeholder
 
-    # 未提出者を不参加扱いに
-    c.execute(
-        f"UPDATE lemon_players SET submitted = TRUE, bid_or_ask = NULL "
-        f"WHERE submitted = FALSE AND class_name = {p}",
-        (class_name,)
-    )
-    conn.commit()
+        # 清算全体を1トランザクションにまとめる（SQLiteは書き込みロックを先に取得）
+        if not conn.is_pg and not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
 
-    players = load_all_players(class_name)
+        # 未提出者を不参加扱いに
+        c.execute(
+            f"UPDATE lemon_players SET submitted = TRUE, bid_or_ask = NULL "
+            f"WHERE submitted = FALSE AND class_name = {p}",
+            (class_name,)
+        )
 
-    prices_arr, demand_arr, supply_arr = compute_demand_supply_curves(players)
-    trade_volume = np.minimum(demand_arr, supply_arr)
+        # 同じトランザクション内で読み直す（別接続だと未コミットの更新が見えない）
+        players = _fetch_players(c, p, class_name)
 
-    if len(trade_volume) > 0 and trade_volume.max() > 0:
-        max_vol = trade_volume.max()
-        candidate_prices = np.where(trade_volume == max_vol)[0]
-        # 取引量最大の価格帯の中央値を採用
-        price = int(candidate_prices[len(candidate_prices) // 2])
-    else:
-        price = 0
-
-    # マッチング: ask <= price の売り手を低い順、bid >= price の買い手を高い順に
-    sellers = [
-        pl for pl in players
-        if pl.get("has_car")
-        and pl.get("bid_or_ask") is not None
-        and pl.get("bid_or_ask") <= price
-    ]
-    buyers = [
-        pl for pl in players
-        if not pl.get("has_car")
-        and pl.get("bid_or_ask") is not None
-        and pl.get("bid_or_ask") >= price
-    ]
-
-    sellers.sort(key=lambda x: x["bid_or_ask"])
-    buyers.sort(key=lambda x: -x["bid_or_ask"])
-
-    # 価格が同じ場合は良品/ポンコツが偏らないようにシャッフル
-    # (ask価格が同じ売り手の中での順序をランダム化)
-    def shuffle_within_groups(lst, key):
-        from itertools import groupby
-        out = []
-        for _, group in groupby(lst, key=key):
-            g = list(group)
-            random.shuffle(g)
-            out.extend(g)
-        return out
-
-    sellers = shuffle_within_groups(sellers, key=lambda x: x["bid_or_ask"])
-    buyers = shuffle_within_groups(buyers, key=lambda x: -x["bid_or_ask"])
-
-    n_trades = min(len(sellers), len(buyers))
-
-    # 各プレイヤーの更新内容を準備
-    updates = {}
-    for pl in players:
-        updates[pl["id"]] = {
-            "unit": 0,
-            "money": pl["money"],
-            "has_car": pl.get("has_car"),
-            "car_type": pl.get("car_type"),
-            "acquired": pl.get("acquired"),
-            "bought_type": None,
-        }
-
-    for i in range(n_trades):
-        seller = sellers[i]
-        buyer = buyers[i]
-        car_type = seller["car_type"]
-
-        updates[seller["id"]]["unit"] = -1
-        updates[seller["id"]]["money"] = seller["money"] + price
-        updates[seller["id"]]["has_car"] = False
-        updates[seller["id"]]["car_type"] = None
-        updates[seller["id"]]["acquired"] = False
-
-        updates[buyer["id"]]["unit"] = 1
-        updates[buyer["id"]]["money"] = buyer["money"] - price
-        updates[buyer["id"]]["has_car"] = True
-        updates[buyer["id"]]["car_type"] = car_type
-        updates[buyer["id"]]["acquired"] = True
-        updates[buyer["id"]]["bought_type"] = car_type
-
-    # ラウンド番号取得
-    c.execute("SELECT round FROM lemon_group_info WHERE id=1")
-    round_num = (row_to_dict(c.fetchone()) or {}).get('round') or 1
+        prices_arr, demand_arr, supply_arr = compute_demand_supply_curves(players)
+        trade_volume = np.minimum(demand_arr, supply_arr)
 
-    # DBに反映 + 履歴記録
-    for pl in players:
-        u = updates[pl["id"]]
-        c.execute(
+        if len(trade_volume) > 0 and trade_volume.max() > 0:
+            max_vol = trade_volume.max()
+            candidate_prices = np.where(trade_volume == max_vol)[0]
+            # 取引量最大の価格帯の中央値を採用
+            price = int(candidate_prices[len(candidate_prices) // 2])
+        else:
+            price = 0
+
+        # マッチング: ask <= price の売り手を低い順、bid >= price の買い手を高い順に
+        sellers = [
+            pl for pl in players
+            if pl.get("has_car")
+            and pl.get("bid_or_ask") is not None
+            and pl.get("bid_or_ask") <= price
+        ]
+        buyers = [
+            pl for pl in players
+            if not pl.get("has_car")
+            and pl.get("bid_or_ask") is not None
+            and pl.get("bid_or_ask") >= price
+        ]
+
+        sellers.sort(key=lambda x: x["bid_or_ask"])
+        buyers.sort(key=lambda x: -x["bid_or_ask"])
+
+        # 価格が同じ場合は良品/ポンコツが偏らないようにシャッフル
+        # (ask価格が同じ売り手の中での順序をランダム化)
+        def shuffle_within_groups(lst, key):
+            from itertools import groupby
+            out = []
+            for _, group in groupby(lst, key=key):
+                g = list(group)
+                random.shuffle(g)
+                out.extend(g)
+            return out
+
+        sellers = shuffle_within_groups(sellers, key=lambda x: x["bid_or_ask"])
+        buyers = shuffle_within_groups(buyers, key=lambda x: -x["bid_or_ask"])
+
+        n_trades = min(len(sellers), len(buyers))
+
+        # 各プレイヤーの更新内容を準備
+        updates = {}
+        for pl in players:
+            updates[pl["id"]] = {
+                "unit": 0,
+                "money": pl["money"],
+                "has_car": pl.get("has_car"),
+                "car_type": pl.get("car_type"),
+                "acquired": pl.get("acquired"),
+                "bought_type": None,
+            }
+
+        for i in range(n_trades):
+            seller = sellers[i]
+            buyer = buyers[i]
+            car_type = seller["car_type"]
+
+            updates[seller["id"]]["unit"] = -1
+            updates[seller["id"]]["money"] = seller["money"] + price
+            updates[seller["id"]]["has_car"] = False
+            updates[seller["id"]]["car_type"] = None
+            updates[seller["id"]]["acquired"] = False
+
+            updates[buyer["id"]]["unit"] = 1
+            updates[buyer["id"]]["money"] = buyer["money"] - price
+            updates[buyer["id"]]["has_car"] = True
+            updates[buyer["id"]]["car_type"] = car_type
+            updates[buyer["id"]]["acquired"] = True
+            updates[buyer["id"]]["bought_type"] = car_type
+
+        # ラウンド番号取得
+        c.execute("SELECT round FROM lemon_group_info WHERE id=1")
+        round_num = (row_to_dict(c.fetchone()) or {}).get('round') or 1
+
+        # DBに反映 + 履歴記録 (executemany で一括)
+        update_rows, history_rows = [], []
+        for pl in players:
+            u = updates[pl["id"]]
+            update_rows.append(
+                (u["unit"], u["money"], u["has_car"], u["car_type"],
+                 u["acquired"], u["bought_type"], pl["id"])
+            )
+            role = "seller" if pl.get("has_car") else "buyer"
+            history_rows.append(
+                (pl["name"], pl["class_name"], round_num, role,
+                 pl.get("car_type"), pl.get("acquired"),
+                 pl.get("bid_or_ask"), u["unit"], u["bought_type"], u["money"])
+            )
+        c.executemany(
             f"UPDATE lemon_players SET unit = {p}, money = {p}, has_car = {p}, "
             f"car_type = {p}, acquired = {p}, bought_type = {p} WHERE id = {p}",
-            (u["unit"], u["money"], u["has_car"], u["car_type"],
-             u["acquired"], u["bought_type"], pl["id"])
+            update_rows
         )
-        role = "seller" if pl.get("has_car") else "buyer"
-        c.execute(
+        c.executemany(
             f"INSERT INTO lemon_player_history "
             f"(name, class_name, round, role, car_type_before, acquired_before, "
             f"bid_or_ask, unit, bought_type, money) "
             f"VALUES ({p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p})",
-            (pl["name"], pl["class_name"], round_num, role,
-             pl.get("car_type"), pl.get("acquired"),
-             pl.get("bid_or_ask"), u["unit"], u["bought_type"], u["money"])
+            history_rows
         )
 
-    c.execute(
-        f"UPDATE lemon_group_info SET final_price = {p}, show_result = TRUE, "
-        f"show_graph = TRUE WHERE id = 1",
-        (price,)
-    )
-    conn.commit()
-    release(conn)
+        c.execute(
+            f"UPDATE lemon_group_info SET final_price = {p}, show_result = TRUE, "
+            f"show_graph = TRUE WHERE id = 1",
+            (price,)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()  # 失敗時は何も反映せず、接続をきれいな状態で返す
+        raise
+    finally:
+        release(conn)
+    clear_read_caches()
     return price
 
 
@@ -435,11 +546,12 @@ def compute_payoff(player):
 
 
 @retry_on_db_lock
+@serialized_write
 def confirm_results(class_name):
     """このラウンドの結果を確定。最終ラウンドなら payoff を計算。"""
     conn = connect()
     c = get_cursor(conn)
-    p = get_placeholder_char(conn)
+    p = conn.placeholder
 
     c.execute("UPDATE lemon_group_info SET confirmed = TRUE WHERE id=1")
     c.execute("SELECT round FROM lemon_group_info WHERE id=1")
@@ -447,56 +559,72 @@ def confirm_results(class_name):
 
     if round_num >= TOTAL_ROUNDS:
         players = load_all_players(class_name)
-        for pl in players:
-            payoff = compute_payoff(pl)
-            c.execute(
-                f"UPDATE lemon_players SET payoff = {p} WHERE id = {p}",
-                (payoff, pl["id"])
-            )
+        c.executemany(
+            f"UPDATE lemon_players SET payoff = {p} WHERE id = {p}",
+            [(compute_payoff(pl), pl["id"]) for pl in players]
+        )
 
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 
 @retry_on_db_lock
+@serialized_write
 def next_round():
     conn = connect()
     c = get_cursor(conn)
-    c.execute(
+    skip_commit_fsync(conn, c)
+    sqls = (
         "UPDATE lemon_group_info SET round = round + 1, final_price = NULL, "
-        "confirmed = FALSE, show_result = FALSE, show_graph = FALSE"
-    )
-    c.execute(
+        "confirmed = FALSE, show_result = FALSE, show_graph = FALSE",
         "UPDATE lemon_players SET submitted = FALSE, bid_or_ask = NULL, "
-        "unit = 0, bought_type = NULL"
+        "unit = 0, bought_type = NULL",
     )
+    if conn.is_pg:
+        c.execute(";\n".join(sqls))  # Postgres は2文を1往復で送る
+    else:
+        for sql in sqls:
+            c.execute(sql)
     conn.commit()
     release(conn)
+    clear_read_caches()
 
 
 @retry_on_db_lock
-def reset_experiment():
+@serialized_write
+def reset_experiment(class_name):
     conn = connect()
     c = get_cursor(conn)
-    if psycopg2 and isinstance(conn, psycopg2.extensions.connection):
-        c.execute("TRUNCATE TABLE lemon_players, lemon_player_history RESTART IDENTITY")
-    else:
-        c.execute("DELETE FROM lemon_players")
-        c.execute("DELETE FROM lemon_player_history")
+    skip_commit_fsync(conn, c)
+    p = conn.placeholder
+    # 対象クラスの行だけ削除する（他クラスのデータとテーブル全体のロックには触れない）
+    c.execute(f"DELETE FROM lemon_players WHERE class_name = {p}", (class_name,))
+    c.execute(f"DELETE FROM lemon_player_history WHERE class_name = {p}", (class_name,))
+    # lemon_group_info は全クラス共有の1行なので、ラウンドなどの進行状態は全クラス分まとめて初期化される
     c.execute(
         "UPDATE lemon_group_info SET final_price=NULL, round=1, "
         "confirmed=FALSE, show_result=FALSE, show_graph=FALSE WHERE id=1"
     )
     conn.commit()
     release(conn)
+    clear_read_caches()
     if "student_id" in st.session_state:
         del st.session_state["student_id"]
 
 
 # --- 7. グラフ描画 ---
 
-def plot_market_curves(prices, demand, supply, final_price=None):
+def get_pyplot():
+    # PNG に書き出すだけなので GUI を持たない Agg バックエンドで読み込む
+    import matplotlib
+    matplotlib.use("Agg")
     import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_market_curves(prices, demand, supply, final_price=None):
+    plt = get_pyplot()
     fig, ax = plt.subplots()
     ax.plot(demand, prices, label="Demand (Buyers)", drawstyle="steps-post")
     ax.plot(supply, prices, label="Supply (Sellers)", drawstyle="steps-post")
@@ -511,34 +639,48 @@ def plot_market_curves(prices, demand, supply, final_price=None):
     return fig
 
 
-@st.cache_data(show_spinner=False, ttl=5)
+@st.cache_data(show_spinner=False, max_entries=32)
+def market_png(prices, demand, supply, final_price=None):
+    """需給曲線(NumPy配列)をキーに描画済みPNGをキャッシュする。"""
+    plt = get_pyplot()
+    fig = plot_market_curves(prices, demand, supply, final_price)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight", dpi=110)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+@st.cache_resource(show_spinner=False, ttl=5)
 def cached_curves(class_name):
+    # 配列のまま全セッションで共有する（ヒットのたびに複製しない）ので読み取り専用にする
     players = load_all_players(class_name)
-    prices, demand, supply = compute_demand_supply_curves(players)
-    return prices.tolist(), demand.tolist(), supply.tolist()
+    curves = compute_demand_supply_curves(players)
+    for a in curves:
+        a.setflags(write=False)
+    return curves
 
 
 def render_market_graph(class_name, final_price=None):
-    import numpy as np
     prices, demand, supply = cached_curves(class_name)
-    fig = plot_market_curves(np.array(prices), np.array(demand),
-                              np.array(supply), final_price)
-    st.pyplot(fig)
+    st.image(market_png(prices, demand, supply, final_price))
 
 
 # --- 8. 集計 ---
 
 def get_trade_summary(class_name):
     """全ラウンド累計の良品/ポンコツ取引数。"""
+    import pandas as pd
     conn = connect()
-    p = get_placeholder_char(conn)
-    df = pd.read_sql_query(
-        f"SELECT bought_type, COUNT(*) as n FROM lemon_player_history "
-        f"WHERE class_name = {p} AND unit = 1 GROUP BY bought_type",
-        conn,
-        params=(class_name,)
-    )
-    release(conn)
+    p = conn.placeholder
+    try:
+        df = pd.read_sql_query(
+            f"SELECT bought_type, COUNT(*) as n FROM lemon_player_history "
+            f"WHERE class_name = {p} AND unit = 1 GROUP BY bought_type",
+            conn,
+            params=(class_name,)
+        )
+    finally:
+        release(conn)  # 失敗してもプールに返す
     summary = {"good": 0, "lemon": 0}
     for _, row in df.iterrows():
         if row["bought_type"] in summary:
@@ -558,6 +700,18 @@ def car_type_label(t):
 
 # --- 10. プレイヤー UI ---
 
+def group_state(group_info):
+    # プレイヤー画面の表示を左右する lemon_group_info の値
+    return tuple(group_info.get(k) for k in ("round", "show_result", "show_graph", "final_price", "confirmed"))
+
+
+@st.fragment(run_every=PLAYER_POLL_SECONDS)
+def wait_for_group_change(state):
+    # 待機中は lemon_group_info だけを定期的に確認し、変わったときだけページ全体を再実行する
+    if group_state(load_group_info()) != state:
+        st.rerun()
+
+
 def show_player_ui(class_name):
     st.subheader("プレイヤーログイン")
     student_id = st.text_input(
@@ -575,8 +729,7 @@ def show_player_ui(class_name):
     group_info = load_group_info()
 
     if player and st.query_params.get("id") != student_id:
-        st.query_params["id"] = student_id
-        st.rerun()
+        st.query_params["id"] = student_id  # URLを更新するだけで再実行はしない
 
     if not player:
         round_num = group_info.get('round') or 1
@@ -621,8 +774,8 @@ def show_player_ui(class_name):
     # 1. 提出済み・結果待ち
     if player['submitted'] and not group_info.get('show_result'):
         st.info("あなたの決定は提出済みです。管理者が市場を清算するまでお待ちください。")
-        if st.button("結果を更新する", type="primary"):
-            st.rerun()
+        st.info("管理者が操作すると、結果が自動で表示されます。")
+        wait_for_group_change(group_state(group_info))
 
     # 2. 結果表示
     elif group_info.get('show_result'):
@@ -682,8 +835,7 @@ def show_player_ui(class_name):
         else:
             st.info("管理者が結果を確定するまでお待ちください。")
 
-        if st.button("状況を更新する"):
-            st.rerun()
+        wait_for_group_change(group_state(group_info))
 
     # 3. 未提出
     else:
@@ -713,6 +865,7 @@ def show_player_ui(class_name):
 # --- 11. 管理者 UI ---
 
 def show_admin_ui(class_name):
+    import pandas as pd  # 管理画面でしか使わないので、起動時には読み込まない
     st.header(f"🔐 管理者モード (クラス: {class_name})")
     ensure_db()
 
@@ -774,11 +927,10 @@ def show_admin_ui(class_name):
         col1.metric("累計: 良品の取引数", summary.get("good", 0))
         col2.metric("累計: ポンコツの取引数", summary.get("lemon", 0))
 
-        df_players = pd.DataFrame(players)
         display_cols = ['name', 'has_car', 'car_type', 'acquired', 'bid_or_ask',
                         'unit', 'bought_type', 'money', 'payoff', 'submitted']
         st.dataframe(
-            df_players[[col for col in display_cols if col in df_players.columns]],
+            pd.DataFrame(players, columns=display_cols),  # 表示する列だけで作る
             use_container_width=True
         )
     else:
@@ -787,32 +939,49 @@ def show_admin_ui(class_name):
     st.sidebar.header("実験制御")
     if st.sidebar.button("🔄 画面を更新"):
         st.rerun()
-    if st.sidebar.button("⚠️ 実験をリセット", help="すべてのデータが削除されます!"):
-        reset_experiment()
+    if st.sidebar.button("⚠️ 実験をリセット", help="このクラスの参加者と履歴がすべて削除されます!ラウンド・清算状態は全クラス共有のため、他のクラスの分も初期化されます。"):
+        reset_experiment(class_name)
         st.sidebar.success("実験をリセットしました。")
         time.sleep(1)
         st.rerun()
 
     st.sidebar.header("📦 履歴ダウンロード")
-    st.sidebar.download_button(
-        "履歴CSVをダウンロード",
-        data=history_csv_blob(class_name),
-        file_name=f"lemon_history_{class_name}_{time.strftime('%Y%m%d')}.csv",
-        mime="text/csv"
-    )
+    # 履歴の読み出しは要求されたときだけ（毎回の再実行で履歴全体を読まない）
+    if st.sidebar.button("履歴CSVを作成"):
+        st.sidebar.download_button(
+            "履歴CSVをダウンロード",
+            data=history_csv_blob(class_name),
+            file_name=f"lemon_history_{class_name}_{time.strftime('%Y%m%d')}.csv",
+            mime="text/csv"
+        )
 
 
 @st.cache_data(show_spinner=False, ttl=30)
 def history_csv_blob(class_name):
     conn = connect()
-    p = get_placeholder_char(conn)
-    df = pd.read_sql_query(
-        f"SELECT * FROM lemon_player_history WHERE class_name = {p}",
-        conn,
-        params=(class_name,)
+    c = conn.cursor()  # 値の並びのまま書き出す
+    p = conn.placeholder
+    # 真偽値の列は文字列にそろえる（Postgres の COPY は t/f、SQLite は 1/0 を書くため、DB によらず True/False にする）
+    query = (
+        "SELECT id, name, class_name, round, role, car_type_before, "
+        "CASE WHEN acquired_before THEN 'True' WHEN NOT acquired_before THEN 'False' END AS acquired_before, "
+        "bid_or_ask, unit, bought_type, money "
+        f"FROM lemon_player_history WHERE class_name = {p} ORDER BY id"
     )
-    release(conn)
-    return df.to_csv(index=False).encode("utf-8")
+    try:
+        if conn.is_pg:
+            # Postgres はサーバー側で CSV 化して流す（COPY はパラメータ不可なので mogrify で埋め込む）
+            buf = io.BytesIO()
+            c.copy_expert(f"COPY ({c.mogrify(query, (class_name,)).decode()}) TO STDOUT WITH CSV HEADER", buf)
+            return buf.getvalue()
+        c.execute(query, (class_name,))
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow([d[0] for d in c.description])
+        writer.writerows(c)
+        return buf.getvalue().encode("utf-8")
+    finally:
+        release(conn)
 
 
 # --- 12. メイン ---